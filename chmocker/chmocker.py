@@ -4,10 +4,14 @@ import argparse
 import tarfile
 import logging
 import hashlib
+import tempfile
 import shutil
+import fcntl
 import json
 import glob
+import sys
 import os
+from contextlib import contextmanager
 from urllib.request import urlretrieve
 from pathlib import Path
 from typing import TextIO
@@ -16,6 +20,9 @@ import validators
 from dockerfile_parse import parser, DockerfileParser
 from termcolor import colored
 
+from chmocker.daemon import DaemonServer, is_daemon_running, submit_job
+from chmocker.scheduler import RESOURCE_CPU, RESOURCE_DISK, RESOURCE_NETWORK, Scheduler, SharedState, track_process
+
 CHMOCKER_DIR_NAME = ".chmo"
 CHMOCKER_DIR_PATH = Path.home() / CHMOCKER_DIR_NAME
 CHMOCKER_BASE_IMAGES_DIR_NAME = "images"
@@ -24,6 +31,14 @@ CHMOCKER_MOUNT_IMAGES_DIR_NAME = "images_mount"
 CHMOCKER_MOUNT_IMAGES_DIR_PATH = CHMOCKER_DIR_PATH / Path(CHMOCKER_MOUNT_IMAGES_DIR_NAME)
 CHMOKER_INDEX_FILE_NAME = "index.json"
 CHMOKER_INDEX_FILE_PATH = CHMOCKER_DIR_PATH / Path(CHMOKER_INDEX_FILE_NAME)
+CHMOCKER_SHARED_BASES_DIR_NAME = "bases"
+CHMOCKER_SHARED_BASES_DIR_PATH = CHMOCKER_DIR_PATH / Path(CHMOCKER_SHARED_BASES_DIR_NAME)
+CHMOCKER_DOWNLOADS_DIR_NAME = "downloads"
+CHMOCKER_DOWNLOADS_DIR_PATH = CHMOCKER_DIR_PATH / Path(CHMOCKER_DOWNLOADS_DIR_NAME)
+CHMOCKER_LOCKS_DIR_NAME = "locks"
+CHMOCKER_LOCKS_DIR_PATH = CHMOCKER_DIR_PATH / Path(CHMOCKER_LOCKS_DIR_NAME)
+CHMOCKER_DAEMON_SOCKET_NAME = "chmockerd.sock"
+CHMOCKER_DAEMON_SOCKET_PATH = CHMOCKER_DIR_PATH / Path(CHMOCKER_DAEMON_SOCKET_NAME)
 
 CHMOCKER_SYSTEM_IMAGE_PATHS = (
     "/bin",
@@ -111,6 +126,13 @@ class Chmoker:
             help="Do not remove unpacked image",
             default=False,
         )
+        build_parser.add_argument(
+            "--no-daemon",
+            dest="build_no_daemon",
+            action="store_true",
+            help="Build in this process even if the daemon is running",
+            default=False,
+        )
 
         run_parser = action_subparsers.add_parser("run")
         run_parser.add_argument("tag", help="Image tag")
@@ -142,9 +164,49 @@ class Chmoker:
             help="Extra container environment variables",
             default=[],
         )
+        run_parser.add_argument(
+            "--no-daemon",
+            dest="run_no_daemon",
+            action="store_true",
+            help="Run in this process even if the daemon is running",
+            default=False,
+        )
         run_parser.add_argument("command", help="Command to execute", nargs="?", default=None)
+
+        daemon_parser = action_subparsers.add_parser("daemon")
+        daemon_parser.add_argument(
+            "-j", "--jobs", dest="daemon_jobs", type=Chmoker.positive_int, help="Max running jobs", default=4
+        )
+        daemon_parser.add_argument(
+            "--cpu-slots",
+            dest="daemon_cpu_slots",
+            type=int,
+            help="Max concurrent RUN instructions, 0 for unlimited",
+            default=2,
+        )
+        daemon_parser.add_argument(
+            "--disk-slots",
+            dest="daemon_disk_slots",
+            type=int,
+            help="Max concurrent unpacking, copying and archiving steps, 0 for unlimited",
+            default=1,
+        )
+        daemon_parser.add_argument(
+            "--network-slots",
+            dest="daemon_network_slots",
+            type=int,
+            help="Max concurrent downloads, 0 for unlimited",
+            default=4,
+        )
         return parser.parse_args()
 
+    @staticmethod
+    def positive_int(value):
+        number = int(value)
+        if number < 1:
+            raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+        return number
+
     @staticmethod
     def check_root():
         if os.geteuid() != 0:
@@ -168,11 +230,46 @@ class Chmoker:
         else:
             shutil.rmtree(path)
 
-    def __init__(self):
+    @staticmethod
+    @contextmanager
+    def publish_path(destination_path):
+        # Every writer gets its own temp file next to the destination, which is swapped in only when complete,
+        # so concurrent jobs publishing the same tar never see or clobber a partial one
+        part_fd, part_path = tempfile.mkstemp(
+            prefix=f"{destination_path.name}.", suffix=".part", dir=destination_path.parent
+        )
+        os.close(part_fd)
+        os.chmod(part_path, 0o644)
+        try:
+            yield Path(part_path)
+            os.replace(part_path, destination_path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    @staticmethod
+    @contextmanager
+    def lock_image_mount(image_tag):
+        # flock works between daemon jobs and in-process runs alike, as each of them opens the lock file on its own
+        with open(CHMOCKER_LOCKS_DIR_PATH / Path(f"{image_tag}.lock"), "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info(f"Waiting for another container of {image_tag} to finish..")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def __init__(self, args=None, output=None, shared=None, context_path=None, is_daemon_job=False):
         self.check_root()
         os.makedirs(CHMOCKER_DIR_PATH, exist_ok=True)
         os.makedirs(CHMOCKER_BASE_IMAGES_DIR_PATH, exist_ok=True)
         os.makedirs(CHMOCKER_MOUNT_IMAGES_DIR_PATH, exist_ok=True)
+        os.makedirs(CHMOCKER_SHARED_BASES_DIR_PATH, exist_ok=True)
+        os.makedirs(CHMOCKER_DOWNLOADS_DIR_PATH, exist_ok=True)
+        os.makedirs(CHMOCKER_LOCKS_DIR_PATH, exist_ok=True)
 
         if not os.path.exists(CHMOKER_INDEX_FILE_PATH):
             with open(CHMOKER_INDEX_FILE_PATH, 'x') as file:
@@ -180,7 +277,12 @@ class Chmoker:
 
         logger = logging.getLogger()
         logger.setLevel(logging.INFO)
-        self.args = self.parse_args()
+        self.args = args or self.parse_args()
+        # Jobs from the daemon stream output to their client and share state with each other
+        self.output = output or sys.stdout
+        self.shared = shared or SharedState()
+        self.context_path = context_path or Path(os.getcwd())
+        self.is_daemon_job = is_daemon_job
 
     def parse_add_instr(self, image_tag, command_value):
         image_mount_path = CHMOCKER_MOUNT_IMAGES_DIR_PATH / Path(image_tag)
@@ -189,23 +291,50 @@ class Chmoker:
         os.makedirs(target_path, exist_ok=True)
         if validators.url(src):
             filename = Path(src).name
-            urlretrieve(src, target_path / Path(filename))
+            if self.shared.share_artifacts:
+                with self.download_shared(src) as download_path:
+                    with self.shared.limiter.acquire(RESOURCE_DISK):
+                        shutil.copy2(download_path, target_path / Path(filename))
+            else:
+                with self.shared.limiter.acquire(RESOURCE_NETWORK):
+                    urlretrieve(src, target_path / Path(filename))
         else:
-            src_path = Path(src)
+            src_path = self.context_path / Path(src)
             if not src_path.exists():
                 raise Exception(f"No such file or directory {src})")
-            if os.path.isdir(src_path):
-                target_dir_path = target_path / Path(src_path.name)
-                shutil.copytree(src_path, f"{target_dir_path}/", dirs_exist_ok=True)
-            elif os.path.isfile(src_path):
-                if tarfile.is_tarfile(src_path):
-                    tar = tarfile.open(src_path)
-                    tar.extractall(path=target_path)
-                    tar.close()
+            with self.shared.limiter.acquire(RESOURCE_DISK):
+                if os.path.isdir(src_path):
+                    target_dir_path = target_path / Path(src_path.name)
+                    shutil.copytree(src_path, f"{target_dir_path}/", dirs_exist_ok=True)
+                elif os.path.isfile(src_path):
+                    if tarfile.is_tarfile(src_path):
+                        tar = tarfile.open(src_path)
+                        tar.extractall(path=target_path)
+                        tar.close()
+                    else:
+                        shutil.copy2(src_path, f"{target_path}/")
                 else:
-                    shutil.copy2(src_path, f"{target_path}/")
-            else:
-                raise Exception(f"Failed to parse {src})")
+                    raise Exception(f"Failed to parse {src})")
+
+    @contextmanager
+    def download_shared(self, url):
+        # Download is shared only with jobs adding the same url at the same time and removed after the last of them,
+        # so builds never get stale content from an earlier download
+        download_path = CHMOCKER_DOWNLOADS_DIR_PATH / Path(hashlib.sha256(url.encode("UTF-8")).hexdigest())
+
+        def download():
+            if download_path.exists():
+                logging.info(f"Using download of {url} from another job")
+                return
+            logging.info(f"Downloading {url} to {download_path}..")
+            download_part_path = download_path.with_suffix(".part")
+            with self.shared.limiter.acquire(RESOURCE_NETWORK):
+                urlretrieve(url, download_part_path)
+            os.replace(download_part_path, download_path)
+
+        with self.shared.downloads.hold(download_path):
+            self.shared.in_flight.run_once(f"download {url}", download)
+            yield download_path
 
     def parse_copy_instr(self, image_tag, command_value):
         if command_value.startswith("--from"):
@@ -218,7 +347,8 @@ class Chmoker:
             if not subdir_and_files:
                 raise Exception(f"Path {src} not found in {previous_stage}")
             image_mount_path = CHMOCKER_MOUNT_IMAGES_DIR_PATH / Path(image_tag)
-            tar.extractall(path=image_mount_path, members=subdir_and_files)
+            with self.shared.limiter.acquire(RESOURCE_DISK):
+                tar.extractall(path=image_mount_path, members=subdir_and_files)
             tar.close()
         else:
             src, dst = command_value.split()
@@ -232,7 +362,8 @@ class Chmoker:
             return  # TODO: implement
         full_line = instr["content"].replace("\n", "")
         command_value = instr["value"]
-        print(colored(full_line, "yellow"))
+        self.output.write(f"{colored(full_line, 'yellow')}\n")
+        self.output.flush()
         if command == "RUN":
             self.exec_in_chroot(image_tag, command_value)
         elif command == "ADD":
@@ -254,9 +385,40 @@ class Chmoker:
                 self.remove_recursive_force(image_mount_path)
         if not image_orig_path.exists():
             raise Exception(f"Base image {image_orig_path} not found!")
-        tar = tarfile.open(image_orig_path)
-        tar.extractall(path=image_mount_path)
-        tar.close()
+        if self.shared.share_artifacts:
+            # Held while cloning too, so the shared base is not pruned under us
+            with self.shared.mount_locks.hold(f"base {base_image_tag}"):
+                shared_base_path = self.unpack_shared_base(base_image_tag)
+                logging.info(f"Cloning shared base {shared_base_path} to {image_mount_path}")
+                os.makedirs(image_mount_path, exist_ok=True)
+                with self.shared.limiter.acquire(RESOURCE_DISK):
+                    # -c makes APFS clones, so every job gets its own tree without copying the data
+                    subprocess.check_call(["cp", "-ac", f"{shared_base_path}/", f"{image_mount_path}/"])
+            return
+        with self.shared.limiter.acquire(RESOURCE_DISK):
+            tar = tarfile.open(image_orig_path)
+            tar.extractall(path=image_mount_path)
+            tar.close()
+
+    def unpack_shared_base(self, base_image_tag):
+        image_orig_path = CHMOCKER_BASE_IMAGES_DIR_PATH / Path(f"{base_image_tag}.tar")
+        image_orig_stat = image_orig_path.stat()
+        # Rebuilt base tars get a new key, older unpacked versions of the tag are removed
+        shared_base_tag_path = CHMOCKER_SHARED_BASES_DIR_PATH / Path(base_image_tag)
+        shared_base_path = shared_base_tag_path / Path(f"{image_orig_stat.st_mtime_ns}-{image_orig_stat.st_size}")
+        if shared_base_path.exists():
+            return shared_base_path
+        os.makedirs(shared_base_tag_path, exist_ok=True)
+        for shared_base_item in os.listdir(shared_base_tag_path):
+            self.remove_recursive_force(shared_base_tag_path / Path(shared_base_item))
+        logging.info(f"Unpacking shared base {image_orig_path} to {shared_base_path}")
+        shared_base_part_path = shared_base_path.with_name(f"{shared_base_path.name}.part")
+        with self.shared.limiter.acquire(RESOURCE_DISK):
+            tar = tarfile.open(image_orig_path)
+            tar.extractall(path=shared_base_part_path)
+            tar.close()
+        os.rename(shared_base_part_path, shared_base_path)
+        return shared_base_path
 
     def prepare_chroot(self, image_tag):
         image_mount_path = CHMOCKER_MOUNT_IMAGES_DIR_PATH / Path(image_tag)
@@ -289,14 +451,37 @@ class Chmoker:
         ]
         env_vars += extra_envs
         env_vars_str = " ".join(env_vars)
-        status = os.system(f"chroot {image_mount_path} env -i {env_vars_str} {command}")  # TODO: interactive cond
-        print(f"chroot {image_mount_path} env -i {env_vars_str} {command}")
-        print(status)
-        exit_code = os.waitstatus_to_exitcode(status)
-        print(exit_code)
+        chroot_command = f"chroot {image_mount_path} env -i {env_vars_str} {command}"
+        if self.is_daemon_job and not run_interactive:
+            # Daemon jobs have no terminal, their output is streamed to the client instead
+            with self.shared.limiter.acquire(RESOURCE_CPU):
+                exit_code = self.stream_command(chroot_command)
+        else:
+            status = os.system(chroot_command)  # TODO: interactive cond
+            print(chroot_command)
+            print(status)
+            exit_code = os.waitstatus_to_exitcode(status)
+            print(exit_code)
         if exit_code != 0 and not run_interactive:
             raise Exception(f"Command '{command}' exited with code {exit_code}")
 
+    def stream_command(self, command):
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.DEVNULL,  # jobs must not read from or block on the daemon's terminal
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            start_new_session=True,  # so a cancelled job can kill the whole command tree
+        )
+        with track_process(process):
+            for line in process.stdout:
+                self.output.write(line)
+                self.output.flush()
+            return process.wait()
+
     def destroy_chroot(self, image_tag):
         logging.info(f"Destroying chroot of {image_tag}")
         image_mount_path = CHMOCKER_MOUNT_IMAGES_DIR_PATH / Path(image_tag)
@@ -308,33 +493,65 @@ class Chmoker:
         image_devfs_mount_path = image_mount_path / Path("dev")
         os.system(f"umount {image_devfs_mount_path}")
 
+    def read_cache_file(self, file_obj: TextIO) -> dict:
+        fcntl.flock(file_obj, fcntl.LOCK_SH)
+        try:
+            file_obj.seek(0)
+            return json.load(file_obj)
+        finally:
+            fcntl.flock(file_obj, fcntl.LOCK_UN)
+
     def write_cache_file(self, file_data: dict, file_obj: TextIO, tag: str, stage_hash: str) -> None:
         logging.info(f"Saving cache data for tag: {tag} and hash: {stage_hash}...")
 
-        file_data[tag] = {'tag': tag, 'hash': stage_hash}
-        file_obj.seek(0)
-        file_obj.write(json.dumps(file_data))
+        # Index is shared with concurrent builds, so merge their entries in before writing
+        fcntl.flock(file_obj, fcntl.LOCK_EX)
+        try:
+            file_obj.seek(0)
+            file_data.update(json.load(file_obj))
+            file_data[tag] = {'tag': tag, 'hash': stage_hash}
+            file_obj.seek(0)
+            file_obj.write(json.dumps(file_data))
+            file_obj.truncate()
+            file_obj.flush()
+        finally:
+            fcntl.flock(file_obj, fcntl.LOCK_UN)
 
         logging.info("Cache data saved")
 
     def save_cache_and_copy_stage(
         self, file_data: dict, file_obj: TextIO, tag: str, stage_hash: str, source_path: Path, destination_path: Path
     ) -> None:
-        self.write_cache_file(file_data=file_data, file_obj=file_obj, tag=tag, stage_hash=stage_hash)
-
         logging.info(f"Copping tar from: {source_path} to: {destination_path}...")
-        shutil.copy2(source_path, destination_path)
+        with self.publish_path(destination_path) as destination_part_path:
+            with self.shared.limiter.acquire(RESOURCE_DISK):
+                shutil.copy2(source_path, destination_part_path)
         logging.info(f"Image tar size {self.get_size_str(destination_path)}")
 
+        # Index entry is written last, so a cache hit always means the tar is in place
+        self.write_cache_file(file_data=file_data, file_obj=file_obj, tag=tag, stage_hash=stage_hash)
+
     def build_stage_if_image_not_exists(
         self, tag_name: str, base_image: str, stage_hash: str, stage_instructions: list
     ) -> None:
-        if not os.path.exists(CHMOCKER_BASE_IMAGES_DIR_PATH / Path(f"{tag_name}.tar")):
-            logging.info(f"No tar found for tag {tag_name} ")
-            self.build_stage(base_image=base_image, image_name=stage_hash, stage_instructions=stage_instructions)
-            return
+        # Identical stages requested by several jobs at once are built only once. The tar check is done
+        # by the building job, so the waiting ones pick up its result only after it is finished
+        stage_key = (
+            f"stage {stage_hash} refresh={self.args.build_force_refresh} "
+            f"no_tar={self.args.build_no_tar} no_remove={self.args.build_no_remove}"
+        )
+
+        def build():
+            with self.lock_image_mount(stage_hash):
+                if os.path.exists(CHMOCKER_BASE_IMAGES_DIR_PATH / Path(f"{tag_name}.tar")):
+                    logging.info(f"Tar for tag {tag_name} already exists, skipping build stage... ")
+                    return
+                logging.info(f"No tar found for tag {tag_name} ")
+                self.build_stage(base_image=base_image, image_name=stage_hash, stage_instructions=stage_instructions)
 
-        logging.info(f"Tar for tag {tag_name} already exists, skipping build stage... ")
+        is_shared = self.shared.in_flight.run_once(stage_key, build)
+        if is_shared:
+            logging.info(f"Stage {stage_hash} was built by another job")
 
     def parse_stages(self) -> list:
         logging.info("Parsing stages from the dockerfile...")
@@ -344,7 +561,7 @@ class Chmoker:
         stage_image_info = (None, None)
         stage_content = ''
 
-        for instruction in DockerfileParser().structure:
+        for instruction in DockerfileParser(path=str(self.context_path)).structure:
             if instruction['instruction'] != 'COMMENT':
                 if instruction['instruction'] == 'FROM':
                     if stage_instructions:
@@ -394,20 +611,16 @@ class Chmoker:
             )
 
             if not stage_name and not stage.get('is_last_stage', False):
-                if os.path.exists(CHMOCKER_BASE_IMAGES_DIR_PATH / Path(f"{stage_current_hash}.tar")):
-                    logging.info(
-                        f"Nothing to rebuild for the stage with the image {base_image}, "
-                        f" and hash {stage_current_hash}"
-                    )
-                    logging.info("Skipping build stage...")
-                else:
-                    self.build_stage(
-                        base_image=base_image, image_name=stage_current_hash, stage_instructions=stage['instructions']
-                    )
+                self.build_stage_if_image_not_exists(
+                    tag_name=stage_current_hash,
+                    base_image=base_image,
+                    stage_hash=stage_current_hash,
+                    stage_instructions=stage['instructions'],
+                )
 
             elif stage_name:
                 with open(CHMOKER_INDEX_FILE_PATH, 'r+') as index_file:
-                    index_file_json = json.load(index_file)
+                    index_file_json = self.read_cache_file(index_file)
                     stage_cache_data = index_file_json.get(stage_name)
 
                     if stage_cache_data:
@@ -463,7 +676,7 @@ class Chmoker:
 
             else:
                 with open(CHMOKER_INDEX_FILE_PATH, 'r+') as index_file:
-                    index_file_json = json.load(index_file)
+                    index_file_json = self.read_cache_file(index_file)
 
                     stage_cache_data = index_file_json.get(result_image_tag)
 
@@ -534,11 +747,13 @@ class Chmoker:
 
     def create_tar_archive(self, tar_path, source_path):
         logging.info(f"Creating tar archive {tar_path}..")
-        tar = tarfile.open(tar_path, "w")
-        for root_dir_item in os.listdir(source_path):
-            root_dir_item_path = source_path / Path(root_dir_item)
-            tar.add(root_dir_item_path, root_dir_item)
-        tar.close()
+        with self.publish_path(tar_path) as tar_part_path:
+            with self.shared.limiter.acquire(RESOURCE_DISK):
+                tar = tarfile.open(tar_part_path, "w")
+                for root_dir_item in os.listdir(source_path):
+                    root_dir_item_path = source_path / Path(root_dir_item)
+                    tar.add(root_dir_item_path, root_dir_item)
+                tar.close()
         logging.info(f"Image tar size {self.get_size_str(tar_path)}")
 
     def copy_dyld_libs_to_image(self, image_mount_path):
@@ -621,21 +836,74 @@ class Chmoker:
             self.image_ls()
 
     def run(self):
-        self.unpack_image(self.args.tag, self.args.tag, self.args.run_force_refresh)
-        self.prepare_chroot(self.args.tag)
-        self.exec_in_chroot(
-            self.args.tag,
-            self.args.command,
-            self.args.run_interactive,
-            self.args.run_extra_envs,
+        # Containers of the same tag share images_mount/<tag>, so they have to take turns
+        with self.lock_image_mount(self.args.tag):
+            self.unpack_image(self.args.tag, self.args.tag, self.args.run_force_refresh)
+            self.prepare_chroot(self.args.tag)
+            try:
+                self.exec_in_chroot(
+                    self.args.tag,
+                    self.args.command,
+                    self.args.run_interactive,
+                    self.args.run_extra_envs,
+                )
+            finally:  # failed or cancelled containers must not leave devfs mounted
+                self.destroy_chroot(self.args.tag)
+                if self.args.run_remove_after:
+                    image_mount_path = CHMOCKER_MOUNT_IMAGES_DIR_PATH / Path(self.args.tag)
+                    self.remove_recursive_force(image_mount_path)
+
+    def daemon(self):
+        # Downloads are only shared between running jobs, leftovers of a previous daemon are useless
+        for download_item in os.listdir(CHMOCKER_DOWNLOADS_DIR_PATH):
+            self.remove_recursive_force(CHMOCKER_DOWNLOADS_DIR_PATH / Path(download_item))
+        limits = {
+            RESOURCE_CPU: self.args.daemon_cpu_slots,
+            RESOURCE_DISK: self.args.daemon_disk_slots,
+            RESOURCE_NETWORK: self.args.daemon_network_slots,
+        }
+        scheduler = Scheduler(self.execute_job, max_jobs=self.args.daemon_jobs, limits=limits)
+        DaemonServer(CHMOCKER_DAEMON_SOCKET_PATH, scheduler).serve()
+
+    @staticmethod
+    def execute_job(job, shared):
+        chmo = Chmoker(
+            args=argparse.Namespace(**job.params["args"]),
+            output=job,
+            shared=shared,
+            context_path=Path(job.params["context"]),
+            is_daemon_job=True,
         )
-        self.destroy_chroot(self.args.tag)
-        if self.args.run_remove_after:
-            image_mount_path = CHMOCKER_MOUNT_IMAGES_DIR_PATH / Path(self.args.tag)
-            self.remove_recursive_force(image_mount_path)
+        if job.action == "build":
+            chmo.build()
+        elif job.action == "run":
+            chmo.run()
+        else:
+            raise Exception(f"Unknown job action {job.action}")
 
-    def main(self):
+    def use_daemon(self):
         if self.args.action == "build":
+            is_requested = not self.args.build_no_daemon
+        elif self.args.action == "run":
+            is_requested = not self.args.run_no_daemon and not self.args.run_interactive
+        else:
+            return False
+        if not is_requested or not CHMOCKER_DAEMON_SOCKET_PATH.exists():
+            return False
+        if not is_daemon_running(CHMOCKER_DAEMON_SOCKET_PATH):
+            logging.warning(f"Daemon socket {CHMOCKER_DAEMON_SOCKET_PATH} is stale, running without the daemon")
+            return False
+        return True
+
+    def main(self):
+        if self.use_daemon():
+            request = {"action": self.args.action, "args": vars(self.args), "context": str(self.context_path)}
+            exit_code = submit_job(CHMOCKER_DAEMON_SOCKET_PATH, request, self.output)
+            if exit_code != 0:
+                sys.exit(exit_code)
+        elif self.args.action == "daemon":
+            self.daemon()
+        elif self.args.action == "build":
             self.build()
         elif self.args.action == "image":
             self.image()
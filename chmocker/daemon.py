@@ -0,0 +1,147 @@
+import socketserver
+import logging
+import threading
+import select
+import signal
+import socket
+import json
+import os
+from pathlib import Path
+from typing import TextIO
+
+from chmocker.scheduler import Scheduler, current_job
+
+DAEMON_REQUEST_TIMEOUT = 10
+DAEMON_CLIENT_POLL_INTERVAL = 1
+
+# Wire protocol: the client sends one JSON line with the job request, the daemon answers with JSON lines
+# {"type": "job", "id": ...}, then any number of {"type": "log", "data": ...} and finally {"type": "exit", "code": ...}
+
+
+class JobLogHandler(logging.Handler):
+    def emit(self, record):
+        job = current_job()
+        if job is None:
+            return
+        try:
+            job.write(f"{self.format(record)}\n")
+        except Exception:
+            self.handleError(record)
+
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def send(self, message: dict) -> None:
+        self.wfile.write(f"{json.dumps(message)}\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def handle(self):
+        self.connection.settimeout(DAEMON_REQUEST_TIMEOUT)
+        try:
+            request_line = self.rfile.readline()
+        except TimeoutError:
+            logging.warning("Client sent no job request, closing the connection")
+            return
+        self.connection.settimeout(None)
+        if not request_line:  # liveness probe, see is_daemon_running
+            return
+        request = json.loads(request_line)
+        job = self.server.scheduler.submit(request["action"], request)
+        is_streaming = threading.Event()
+        is_streaming.set()
+        watcher = threading.Thread(target=self.watch_client, args=(job, is_streaming), daemon=True)
+        watcher.start()
+        try:
+            self.send({"type": "job", "id": job.id})
+            for text in job.output():
+                self.send({"type": "log", "data": text})
+            self.send({"type": "exit", "code": job.exit_code})
+        except (BrokenPipeError, ConnectionResetError):
+            self.client_gone(job)
+        finally:
+            is_streaming.clear()
+            watcher.join()
+
+    def watch_client(self, job, is_streaming: threading.Event) -> None:
+        # Clients send nothing after the request, so a readable connection means they went away
+        while is_streaming.is_set() and not job.done.wait(DAEMON_CLIENT_POLL_INTERVAL):
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            if readable and not self.connection.recv(1, socket.MSG_PEEK):
+                self.client_gone(job)
+                return
+
+    def client_gone(self, job) -> None:
+        # Containers are of no use without their client, builds are kept as other jobs may share their stages
+        if job.action == "run" and not job.done.is_set():
+            job.cancel("Client disconnected")
+        else:
+            logging.warning(f"Client of job {job.id} disconnected, the job keeps running")
+
+
+def raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+class DaemonServer(socketserver.ThreadingUnixStreamServer):
+    # Handler threads are joined on close, so clients of jobs that finish during shutdown still get their exit code
+    daemon_threads = False
+
+    def __init__(self, socket_path: Path, scheduler: Scheduler):
+        if socket_path.exists():
+            if is_daemon_running(socket_path):
+                raise Exception(f"Daemon is already listening on {socket_path}")
+            logging.warning(f"Removing stale daemon socket {socket_path}")
+            os.unlink(socket_path)
+        self.socket_path = socket_path
+        self.scheduler = scheduler
+        super().__init__(str(socket_path), DaemonRequestHandler)
+        os.chmod(socket_path, 0o600)
+
+    def serve(self) -> None:
+        logging.basicConfig()
+        log_handler = JobLogHandler()
+        log_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+        logging.getLogger().addHandler(log_handler)
+        if threading.current_thread() is threading.main_thread():
+            # launchd and friends stop services with SIGTERM, shut down the same way as on Ctrl-C
+            signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+        self.scheduler.start()
+        logging.info(f"Daemon is listening on {self.socket_path}")
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Daemon is shutting down..")
+        finally:
+            self.socket.close()
+            os.unlink(self.socket_path)
+            self.scheduler.stop()
+            self.server_close()
+            logging.getLogger().removeHandler(log_handler)
+
+
+def is_daemon_running(socket_path: Path) -> bool:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(socket_path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            return False
+    return True
+
+
+def submit_job(socket_path: Path, request: dict, output: TextIO) -> int:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(str(socket_path))
+        except (ConnectionRefusedError, FileNotFoundError):  # stale socket, or the daemon has just stopped
+            raise Exception(f"Daemon is not responding on {socket_path}, use '--no-daemon' to run without it")
+        client.sendall(f"{json.dumps(request)}\n".encode("utf-8"))
+        with client.makefile("r", encoding="utf-8") as responses:
+            for line in responses:
+                message = json.loads(line)
+                if message["type"] == "job":
+                    logging.info(f"Submitted job {message['id']} to the daemon")
+                elif message["type"] == "log":
+                    output.write(message["data"])
+                    output.flush()
+                elif message["type"] == "exit":
+                    return message["code"]
+    raise Exception("Daemon closed the connection before the job finished")
@@ -0,0 +1,276 @@
+import threading
+import itertools
+import logging
+import signal
+import queue
+import os
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Callable, Optional
+
+RESOURCE_CPU = "cpu"
+RESOURCE_DISK = "disk"
+RESOURCE_NETWORK = "network"
+
+JOB_STATUS_QUEUED = "queued"
+JOB_STATUS_RUNNING = "running"
+JOB_STATUS_DONE = "done"
+JOB_STATUS_FAILED = "failed"
+
+_current = threading.local()
+
+
+def current_job():
+    return getattr(_current, "job", None)
+
+
+def kill_process_group(process) -> None:
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+@contextmanager
+def track_process(process):
+    # Lets a cancelled job kill the process group, so the process must be started with start_new_session=True
+    job = current_job()
+    if job is None:
+        yield
+        return
+    with job.lock:
+        job.processes.add(process)
+        is_cancelled = job.cancelled.is_set()
+    if is_cancelled:
+        kill_process_group(process)
+    try:
+        yield
+    finally:
+        with job.lock:
+            job.processes.discard(process)
+
+
+class ResourceLimiter:
+    def __init__(self, limits: Optional[dict] = None):
+        # Resources without a limit (or with a non-positive one) are not limited at all
+        self.semaphores = {
+            resource: threading.BoundedSemaphore(limit) for resource, limit in (limits or {}).items() if limit > 0
+        }
+
+    def acquire(self, resource: str):
+        semaphore = self.semaphores.get(resource)
+        if semaphore is None:
+            return nullcontext()
+        return self.hold(resource, semaphore)
+
+    @contextmanager
+    def hold(self, resource: str, semaphore: threading.BoundedSemaphore):
+        if not semaphore.acquire(blocking=False):
+            logging.info(f"Waiting for a free {resource} slot..")
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+class InFlight:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def run_once(self, key: str, func: Callable) -> bool:
+        # Runs func unless the same key is already running somewhere else, in which case waits for it
+        # and re-raises its error. Returns True if the result was shared with another caller.
+        with self.lock:
+            future = self.futures.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.futures[key] = future
+        if not is_owner:
+            logging.info(f"Waiting for in-flight {key}..")
+            future.result()
+            return True
+        try:
+            func()
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(None)
+        finally:
+            with self.lock:
+                del self.futures[key]
+        return False
+
+
+class KeyedLock:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextmanager
+    def hold(self, key: str):
+        with self.lock:
+            key_lock, users = self.locks.get(key, (threading.Lock(), 0))
+            self.locks[key] = (key_lock, users + 1)
+        try:
+            with key_lock:
+                yield
+        finally:
+            with self.lock:
+                key_lock, users = self.locks[key]
+                if users == 1:
+                    del self.locks[key]
+                else:
+                    self.locks[key] = (key_lock, users - 1)
+
+
+class FileLeases:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+
+    @contextmanager
+    def hold(self, path: Path):
+        # The file is removed as soon as the last holder is done with it
+        with self.lock:
+            self.users[path] = self.users.get(path, 0) + 1
+        try:
+            yield path
+        finally:
+            with self.lock:
+                self.users[path] -= 1
+                if self.users[path] == 0:
+                    del self.users[path]
+                    if path.exists():
+                        os.remove(path)
+
+
+class SharedState:
+    def __init__(self, limits: Optional[dict] = None, share_artifacts: bool = False):
+        self.limiter = ResourceLimiter(limits)
+        self.in_flight = InFlight()
+        self.mount_locks = KeyedLock()
+        self.downloads = FileLeases()
+        self.share_artifacts = share_artifacts
+
+
+class Job:
+    def __init__(self, job_id: int, action: str, params: dict):
+        self.id = job_id
+        self.action = action
+        self.params = params
+        self.status = JOB_STATUS_QUEUED
+        self.exit_code = None
+        self.log = queue.Queue()
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def write(self, text: str) -> None:
+        self.log.put(text)
+
+    def flush(self) -> None:
+        pass
+
+    def finish(self, exit_code: int) -> None:
+        self.exit_code = exit_code
+        self.status = JOB_STATUS_DONE if exit_code == 0 else JOB_STATUS_FAILED
+        self.done.set()
+        self.log.put(None)
+
+    def cancel(self, reason: str) -> None:
+        logging.warning(f"Cancelling job {self.id} ({self.action}): {reason}")
+        self.write(f"{reason}, job cancelled\n")
+        with self.lock:
+            self.cancelled.set()
+            processes = list(self.processes)
+        for process in processes:
+            kill_process_group(process)
+
+    def output(self):
+        while (text := self.log.get()) is not None:
+            yield text
+
+
+class Scheduler:
+    def __init__(
+        self, executor: Callable, max_jobs: int = 2, limits: Optional[dict] = None, share_artifacts: bool = True
+    ):
+        # executor(job, shared) does the actual work, so the scheduler itself can run with a fake one
+        if max_jobs < 1:
+            raise Exception(f"Scheduler needs at least one job slot, got {max_jobs}")
+        self.executor = executor
+        self.max_jobs = max_jobs
+        self.shared = SharedState(limits, share_artifacts)
+        self.queue = queue.Queue()
+        self.workers = []
+        self.running = set()
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.is_stopping = False
+
+    def start(self) -> None:
+        for n in range(self.max_jobs):
+            worker = threading.Thread(target=self.worker, name=f"chmocker-worker-{n + 1}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self) -> None:
+        # Running jobs get their commands killed, but are waited for, so they get to clean up their chroots
+        with self.lock:
+            self.is_stopping = True
+            while not self.queue.empty():
+                self.cancel_queued(self.queue.get_nowait())
+            for job in self.running:
+                job.cancel("Daemon is shutting down")
+            for _ in self.workers:
+                self.queue.put(None)
+        logging.info("Waiting for running jobs to finish..")
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+    def cancel_queued(self, job: Job) -> None:
+        job.cancel("Daemon is shutting down")
+        job.finish(1)
+
+    def submit(self, action: str, params: dict) -> Job:
+        job = Job(next(self.job_ids), action, params)
+        with self.lock:
+            if self.is_stopping:
+                self.cancel_queued(job)
+                return job
+            logging.info(f"Queued job {job.id} ({action}), {self.queue.qsize()} jobs waiting")
+            self.queue.put(job)
+        return job
+
+    def worker(self) -> None:
+        while (job := self.queue.get()) is not None:
+            self.execute(job)
+
+    def execute(self, job: Job) -> None:
+        with self.lock:
+            if job.cancelled.is_set():  # cancelled while queued
+                job.finish(1)
+                return
+            self.running.add(job)
+        _current.job = job
+        job.status = JOB_STATUS_RUNNING
+        logging.info(f"Starting job {job.id} ({job.action})")
+        exit_code = 1
+        try:
+            self.executor(job, self.shared)
+            exit_code = 1 if job.cancelled.is_set() else 0
+        except Exception:
+            logging.exception(f"Job {job.id} ({job.action}) failed")
+        finally:
+            logging.info(f"Job {job.id} ({job.action}) finished with code {exit_code}")
+            _current.job = None
+            with self.lock:
+                self.running.discard(job)
+            job.finish(exit_code)
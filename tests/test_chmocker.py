@@ -0,0 +1,89 @@
+import threading
+import time
+
+import pytest
+
+import chmocker.chmocker
+from chmocker.chmocker import Chmoker
+
+
+def test_publish_path_concurrent_writers_never_publish_partial_file(tmp_path):
+    destination_path = tmp_path / "stage.tar"
+    contents = {n: bytes([n]) * 4096 for n in range(4)}
+    errors = []
+    published = []
+
+    def writer(n):
+        try:
+            with Chmoker.publish_path(destination_path) as part_path:
+                with open(part_path, "wb") as part_file:
+                    for offset in range(0, 4096, 1024):
+                        part_file.write(contents[n][offset : offset + 1024])
+                        part_file.flush()
+                        time.sleep(0.01)
+            published.append(destination_path.read_bytes())
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert all(content in contents.values() for content in published)
+    assert destination_path.read_bytes() in contents.values()
+    assert [path.name for path in tmp_path.iterdir()] == ["stage.tar"]
+
+
+def test_publish_path_failed_writer_leaves_destination_untouched(tmp_path):
+    destination_path = tmp_path / "stage.tar"
+    destination_path.write_bytes(b"complete")
+
+    with pytest.raises(RuntimeError):
+        with Chmoker.publish_path(destination_path) as part_path:
+            part_path.write_bytes(b"part")
+            raise RuntimeError("copy failed")
+
+    assert destination_path.read_bytes() == b"complete"
+    assert [path.name for path in tmp_path.iterdir()] == ["stage.tar"]
+
+
+def test_lock_image_mount_serialises_same_tag(tmp_path, monkeypatch):
+    monkeypatch.setattr(chmocker.chmocker, "CHMOCKER_LOCKS_DIR_PATH", tmp_path)
+    lock = threading.Lock()
+    holders = []
+    peak = []
+
+    def container(n):
+        with Chmoker.lock_image_mount("tag"):
+            with lock:
+                holders.append(n)
+                peak.append(len(holders))
+            time.sleep(0.05)
+            with lock:
+                holders.remove(n)
+
+    threads = [threading.Thread(target=container, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(peak) == 1
+
+
+def test_lock_image_mount_does_not_serialise_different_tags(tmp_path, monkeypatch):
+    monkeypatch.setattr(chmocker.chmocker, "CHMOCKER_LOCKS_DIR_PATH", tmp_path)
+    barrier = threading.Barrier(2, timeout=5)
+
+    def container(n):
+        with Chmoker.lock_image_mount(f"tag-{n}"):
+            barrier.wait()
+
+    threads = [threading.Thread(target=container, args=(n,)) for n in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,157 @@
+import io
+import json
+import logging
+import socket
+import subprocess
+import threading
+import time
+
+import pytest
+
+from chmocker.daemon import DAEMON_CLIENT_POLL_INTERVAL, DaemonServer, is_daemon_running, submit_job
+from chmocker.scheduler import Scheduler, track_process
+
+
+@pytest.fixture
+def daemon(tmp_path, caplog):
+    caplog.set_level(logging.INFO)  # done by Chmoker for real jobs
+    def executor(job, shared):
+        job.write(f"building {job.params['tag']}\n")
+        logging.info(f"log of {job.params['tag']}")
+        if job.params["tag"] == "broken":
+            raise RuntimeError("boom")
+
+    socket_path = tmp_path / "chmockerd.sock"
+    server = DaemonServer(socket_path, Scheduler(executor, max_jobs=2))
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    yield socket_path
+    server.shutdown()
+    thread.join()
+    assert not socket_path.exists()
+
+
+def test_submit_job_streams_output_and_exit_code(daemon):
+    output = io.StringIO()
+    assert submit_job(daemon, {"action": "build", "tag": "ok"}, output) == 0
+    assert "building ok\n" in output.getvalue()
+    assert "INFO: log of ok\n" in output.getvalue()
+
+
+def test_submit_job_returns_failed_exit_code(daemon):
+    output = io.StringIO()
+    assert submit_job(daemon, {"action": "build", "tag": "broken"}, output) == 1
+    assert "RuntimeError: boom" in output.getvalue()
+
+
+def test_is_daemon_running(daemon):
+    assert is_daemon_running(daemon)
+
+
+def test_stale_socket_is_not_running_and_gets_replaced(tmp_path):
+    socket_path = tmp_path / "chmockerd.sock"
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(str(socket_path))
+    stale.close()
+
+    assert socket_path.exists()
+    assert not is_daemon_running(socket_path)
+    server = DaemonServer(socket_path, Scheduler(lambda job, shared: None))
+    server.server_close()
+
+
+def test_job_finishing_during_shutdown_still_reports_exit_code(tmp_path):
+    started = threading.Event()
+    release = threading.Event()
+
+    def executor(job, shared):
+        started.set()
+        release.wait()
+        job.write("finished\n")
+
+    socket_path = tmp_path / "chmockerd.sock"
+    server = DaemonServer(socket_path, Scheduler(executor, max_jobs=1))
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    results = []
+    output = io.StringIO()
+    client = threading.Thread(target=lambda: results.append(submit_job(socket_path, {"action": "build"}, output)))
+    client.start()
+    started.wait(5)
+
+    server.shutdown()
+    release.set()
+    thread.join()
+    client.join()
+
+    assert results == [0]
+    assert "finished\n" in output.getvalue()
+
+
+def disconnect_after_submit(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        client.sendall(f"{json.dumps(request)}\n".encode("utf-8"))
+        with client.makefile("r", encoding="utf-8") as responses:
+            assert json.loads(responses.readline())["type"] == "job"
+
+
+@pytest.fixture
+def blocking_daemon(tmp_path):
+    jobs = {}
+    release = threading.Event()
+
+    def executor(job, shared):
+        jobs[job.params["tag"]] = job
+        process = subprocess.Popen(["sleep", "30"], start_new_session=True)
+        with track_process(process):
+            if job.action == "build":
+                release.wait(10)
+                process.terminate()
+            process.wait()
+
+    socket_path = tmp_path / "chmockerd.sock"
+    server = DaemonServer(socket_path, Scheduler(executor, max_jobs=2))
+    thread = threading.Thread(target=server.serve)
+    thread.start()
+    yield socket_path, jobs, release
+    release.set()
+    server.shutdown()
+    thread.join()
+
+
+def wait_for_job(jobs, tag):
+    deadline = time.monotonic() + 5
+    while tag not in jobs:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return jobs[tag]
+
+
+def test_client_disconnect_cancels_run_job(blocking_daemon):
+    socket_path, jobs, release = blocking_daemon
+    disconnect_after_submit(socket_path, {"action": "run", "tag": "container"})
+
+    job = wait_for_job(jobs, "container")
+
+    assert job.done.wait(5)
+    assert job.exit_code == 1
+    assert job.cancelled.is_set()
+
+
+def test_client_disconnect_keeps_build_job(blocking_daemon):
+    socket_path, jobs, release = blocking_daemon
+    disconnect_after_submit(socket_path, {"action": "build", "tag": "image"})
+
+    job = wait_for_job(jobs, "image")
+    time.sleep(DAEMON_CLIENT_POLL_INTERVAL * 2)
+
+    assert not job.cancelled.is_set()
+    release.set()
+    assert job.done.wait(5)
+    assert job.exit_code == 0
+
+
+def test_submit_job_without_socket_suggests_no_daemon(tmp_path):
+    with pytest.raises(Exception, match="--no-daemon"):
+        submit_job(tmp_path / "chmockerd.sock", {"action": "build"}, io.StringIO())
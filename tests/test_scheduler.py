@@ -0,0 +1,326 @@
+import logging
+import subprocess
+import threading
+import time
+
+import pytest
+
+from chmocker.scheduler import (
+    RESOURCE_CPU,
+    RESOURCE_DISK,
+    RESOURCE_NETWORK,
+    JOB_STATUS_DONE,
+    JOB_STATUS_FAILED,
+    FileLeases,
+    InFlight,
+    KeyedLock,
+    ResourceLimiter,
+    Scheduler,
+    track_process,
+)
+
+
+class ConcurrencyCounter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def hold(self, seconds=0.05):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+        time.sleep(seconds)
+        with self.lock:
+            self.current -= 1
+
+
+def wait_for_in_flight_waiters(caplog, count):
+    # Waiters log before blocking on the owner, so once logged they are bound to get its result
+    deadline = time.monotonic() + 5
+    while sum(record.getMessage().startswith("Waiting for in-flight") for record in caplog.records) < count:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_in_flight_runs_func_once_for_concurrent_callers(caplog):
+    caplog.set_level(logging.INFO)
+    in_flight = InFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    is_shared = {}
+
+    def build():
+        calls.append(1)
+        started.set()
+        release.wait()
+
+    def caller(n):
+        if n != 0:
+            started.wait()
+        is_shared[n] = in_flight.run_once("stage", build)
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    wait_for_in_flight_waiters(caplog, 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(is_shared.values()) == [False, True, True, True]
+    assert in_flight.futures == {}
+
+
+def test_in_flight_error_reaches_waiters(caplog):
+    caplog.set_level(logging.INFO)
+    in_flight = InFlight()
+    started = threading.Event()
+    release = threading.Event()
+    errors = {}
+
+    def build():
+        started.set()
+        release.wait()
+        raise RuntimeError("stage failed")
+
+    def caller(n):
+        if n != 0:
+            started.wait()
+        try:
+            in_flight.run_once("stage", build)
+        except RuntimeError as error:
+            errors[n] = str(error)
+
+    threads = [threading.Thread(target=caller, args=(n,)) for n in range(3)]
+    for thread in threads:
+        thread.start()
+    started.wait()
+    wait_for_in_flight_waiters(caplog, 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == {0: "stage failed", 1: "stage failed", 2: "stage failed"}
+    assert in_flight.futures == {}
+
+
+def test_in_flight_runs_again_after_completion():
+    in_flight = InFlight()
+    calls = []
+    in_flight.run_once("stage", lambda: calls.append(1))
+    in_flight.run_once("stage", lambda: calls.append(1))
+    assert len(calls) == 2
+
+
+@pytest.mark.parametrize("resource", [RESOURCE_CPU, RESOURCE_DISK, RESOURCE_NETWORK])
+def test_resource_limiter_limits_each_resource(resource):
+    limiter = ResourceLimiter({RESOURCE_CPU: 2, RESOURCE_DISK: 1, RESOURCE_NETWORK: 3})
+    limited = ConcurrencyCounter()
+
+    def worker(n):
+        with limiter.acquire(resource):
+            limited.hold()
+
+    run_threads(6, worker)
+
+    assert limited.peak == {RESOURCE_CPU: 2, RESOURCE_DISK: 1, RESOURCE_NETWORK: 3}[resource]
+
+
+def test_resource_limiter_without_limits_does_not_block():
+    limiter = ResourceLimiter({RESOURCE_CPU: 0})
+    counter = ConcurrencyCounter()
+    barrier = threading.Barrier(4, timeout=5)
+
+    def worker(n):
+        with limiter.acquire(RESOURCE_CPU), limiter.acquire(RESOURCE_DISK):
+            barrier.wait()
+            counter.hold(0)
+
+    run_threads(4, worker)
+
+    assert limiter.semaphores == {}
+
+
+def test_keyed_lock_serialises_same_key():
+    locks = KeyedLock()
+    counter = ConcurrencyCounter()
+
+    def worker(n):
+        with locks.hold("images_mount/tag"):
+            counter.hold()
+
+    run_threads(4, worker)
+
+    assert counter.peak == 1
+    assert locks.locks == {}
+
+
+def test_keyed_lock_does_not_serialise_different_keys():
+    locks = KeyedLock()
+    barrier = threading.Barrier(3, timeout=5)
+
+    def worker(n):
+        with locks.hold(f"tag-{n}"):
+            barrier.wait()
+
+    run_threads(3, worker)
+
+    assert locks.locks == {}
+
+
+def test_file_leases_remove_file_after_last_holder(tmp_path):
+    leases = FileLeases()
+    download_path = tmp_path / "download"
+    with leases.hold(download_path):
+        download_path.write_text("data")
+        with leases.hold(download_path):
+            pass
+        assert download_path.exists()
+    assert not download_path.exists()
+    assert leases.users == {}
+
+
+def test_scheduler_runs_jobs_with_fake_executor():
+    counter = ConcurrencyCounter()
+
+    def executor(job, shared):
+        job.write(f"job {job.params['n']}\n")
+        counter.hold()
+        if job.params["n"] == 3:
+            raise RuntimeError("boom")
+
+    scheduler = Scheduler(executor, max_jobs=2)
+    scheduler.start()
+    jobs = [scheduler.submit("build", {"n": n}) for n in range(5)]
+    outputs = [list(job.output()) for job in jobs]
+    scheduler.stop()
+
+    assert counter.peak == 2
+    assert [job.exit_code for job in jobs] == [0, 0, 0, 1, 0]
+    assert [job.status for job in jobs] == [JOB_STATUS_DONE] * 3 + [JOB_STATUS_FAILED, JOB_STATUS_DONE]
+    assert all(output[0] == f"job {n}\n" for n, output in enumerate(outputs))
+
+
+def test_scheduler_deduplicates_stages_between_jobs(caplog):
+    caplog.set_level(logging.INFO)
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def build():
+        calls.append(1)
+        started.set()
+        release.wait()
+
+    def executor(job, shared):
+        shared.in_flight.run_once("stage", build)
+
+    scheduler = Scheduler(executor, max_jobs=3)
+    scheduler.start()
+    jobs = [scheduler.submit("build", {}) for _ in range(3)]
+    started.wait()
+    wait_for_in_flight_waiters(caplog, 2)
+    release.set()
+    for job in jobs:
+        job.done.wait(5)
+    scheduler.stop()
+
+    assert len(calls) == 1
+    assert [job.exit_code for job in jobs] == [0, 0, 0]
+
+
+def test_scheduler_stop_cancels_queued_jobs():
+    started = threading.Event()
+    release = threading.Event()
+
+    def executor(job, shared):
+        started.set()
+        release.wait()
+
+    scheduler = Scheduler(executor, max_jobs=1)
+    scheduler.start()
+    running = scheduler.submit("build", {})
+    queued = scheduler.submit("build", {})
+    started.wait()
+    stopper = threading.Thread(target=scheduler.stop)
+    stopper.start()
+    queued.done.wait(5)
+    late = scheduler.submit("build", {})
+    assert not running.done.is_set()
+    release.set()
+    stopper.join()
+
+    assert running.exit_code == 1
+    assert queued.exit_code == 1
+    assert late.exit_code == 1
+    assert "job cancelled" in "".join(queued.output())
+
+
+@pytest.mark.parametrize("max_jobs", [0, -1])
+def test_scheduler_rejects_no_job_slots(max_jobs):
+    with pytest.raises(Exception, match="at least one job slot"):
+        Scheduler(lambda job, shared: None, max_jobs=max_jobs)
+
+
+def sleeping_executor(started):
+    def executor(job, shared):
+        process = subprocess.Popen(["sleep", "30"], start_new_session=True)
+        with track_process(process):
+            started.set()
+            process.wait()
+
+    return executor
+
+
+def test_cancel_kills_running_job_process():
+    started = threading.Event()
+    scheduler = Scheduler(sleeping_executor(started), max_jobs=1)
+    scheduler.start()
+    job = scheduler.submit("run", {})
+    started.wait(5)
+
+    job.cancel("Client disconnected")
+
+    assert job.done.wait(5)
+    assert job.exit_code == 1
+    assert "Client disconnected, job cancelled\n" in "".join(job.output())
+    scheduler.stop()
+
+
+def test_cancelled_queued_job_does_not_run():
+    calls = []
+    scheduler = Scheduler(lambda job, shared: calls.append(job.id), max_jobs=1)
+    job = scheduler.submit("run", {})
+    job.cancel("Client disconnected")
+    scheduler.start()
+
+    assert job.done.wait(5)
+    assert job.exit_code == 1
+    assert calls == []
+    scheduler.stop()
+
+
+def test_scheduler_stop_cancels_running_jobs():
+    started = threading.Event()
+    scheduler = Scheduler(sleeping_executor(started), max_jobs=1)
+    scheduler.start()
+    job = scheduler.submit("run", {})
+    started.wait(5)
+
+    start = time.monotonic()
+    scheduler.stop()
+
+    assert time.monotonic() - start < 5
+    assert job.exit_code == 1